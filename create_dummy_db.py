@@ -3,15 +3,32 @@ import sqlite3
 def create_dummy():
     conn = sqlite3.connect("osm.mbtiles")
     c = conn.cursor()
-    # Create the standard MBTiles schema
+    # Page size only takes effect before the first table is created;
+    # WAL is persistent, so the tile server can read while the file is rewritten
+    c.execute("PRAGMA page_size=4096;")
+    c.execute("PRAGMA journal_mode=WAL;")
+    # Create the deduplicated MBTiles schema (as written by tippecanoe):
+    # tile coordinates live in a clustered WITHOUT ROWID table, so a lookup is one
+    # B-tree descent, and identical tiles share a single row in images.
+    # The tiles view keeps the standard MBTiles query interface.
     c.execute("CREATE TABLE metadata (name text, value text);")
-    c.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);")
     c.execute("create unique index name on metadata (name);")
-    c.execute("create unique index tile_index on tiles (zoom_level, tile_column, tile_row);")
+    c.execute(
+        "CREATE TABLE map (zoom_level integer, tile_column integer, tile_row integer, tile_id integer, "
+        "PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;"
+    )
+    c.execute("CREATE TABLE images (tile_id integer PRIMARY KEY, tile_data blob);")
+    c.execute(
+        "CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+        "map.tile_row AS tile_row, images.tile_data AS tile_data "
+        "FROM map JOIN images ON images.tile_id = map.tile_id;"
+    )
     
     # Insert metadata
     c.execute("INSERT INTO metadata VALUES ('name', 'dummy-map');")
     c.execute("INSERT INTO metadata VALUES ('format', 'pbf');")
+    # Tiles are stored gzipped; the server reads this once instead of checking every tile
+    c.execute("INSERT INTO metadata VALUES ('compression', 'gzip');")
     
     conn.commit()
     conn.close()
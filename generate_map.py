@@ -1,8 +1,16 @@
+import gzip
 import os
+import sqlite3
 import requests
 import subprocess
 import sys
 
+# Optional: zopfli produces gzip streams a few percent smaller than gzip -9
+try:
+    from zopfli.gzip import compress as zopfli_compress
+except ImportError:
+    zopfli_compress = None
+
 # --- Configuration ---
 # Bounding box for Moffett Field, CA (min_lon, min_lat, max_lon, max_lat)
 BBOX = "-122.43,37.41,-122.41,37.42"
@@ -15,10 +23,63 @@ PROCESS_URL = "https://raw.githubusercontent.com/systemed/tilemaker/master/resou
 
 def download_file(url, filename):
     print(f"Downloading {filename}...")
-    r = requests.get(url, allow_redirects=True)
-    r.raise_for_status()
-    with open(filename, 'wb') as f:
-        f.write(r.content)
+    # Stream to disk in 1 MiB chunks so large OSM extracts are never held in memory
+    with requests.get(url, allow_redirects=True, stream=True) as r:
+        r.raise_for_status()
+        with open(filename, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+
+def compress_tile(tile_data):
+    """Returns the tile gzipped as tightly as available (zopfli, else gzip -9)."""
+    if tile_data[:2] == b'\x1f\x8b':
+        tile_data = gzip.decompress(tile_data)
+    if zopfli_compress is not None:
+        return zopfli_compress(tile_data, numiterations=15)
+    return gzip.compress(tile_data, compresslevel=9, mtime=0)
+
+def compress_tiles(mbtiles_file):
+    """
+    Recompresses every stored tile once, ahead of time, so the server only
+    passes gzip bytes through. A tile is only rewritten if the result is smaller.
+    """
+    conn = sqlite3.connect(mbtiles_file)
+    # Deduplicated MBTiles keep blobs in images; plain ones in the tiles table
+    has_images = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='images'"
+    ).fetchone()
+    table, key = ("images", "tile_id") if has_images else ("tiles", "rowid")
+
+    ids = [row[0] for row in conn.execute(f"SELECT {key} FROM {table}")]
+    saved = 0
+    for tile_id in ids:
+        (tile_data,) = conn.execute(f"SELECT tile_data FROM {table} WHERE {key}=?", (tile_id,)).fetchone()
+        compressed = compress_tile(tile_data)
+        if len(compressed) < len(tile_data) or tile_data[:2] != b'\x1f\x8b':
+            conn.execute(f"UPDATE {table} SET tile_data=? WHERE {key}=?", (compressed, tile_id))
+            saved += len(tile_data) - len(compressed)
+    conn.commit()
+    conn.close()
+    method = "zopfli" if zopfli_compress is not None else "gzip -9"
+    print(f"Recompressed {len(ids)} tiles with {method}, saved {saved} bytes")
+
+def record_compression(mbtiles_file):
+    """
+    Stores the tile compression in the MBTiles metadata ('gzip' or 'none'),
+    so the tile server can set Content-Encoding without inspecting every tile.
+    """
+    conn = sqlite3.connect(mbtiles_file)
+    row = conn.execute("SELECT tile_data FROM tiles LIMIT 1").fetchone()
+    if row is None:
+        # No tiles to inspect: leave it unrecorded and let the server detect it per tile
+        conn.close()
+        return
+    compression = "gzip" if row[0][:2] == b'\x1f\x8b' else "none"
+    conn.execute("DELETE FROM metadata WHERE name='compression'")
+    conn.execute("INSERT INTO metadata (name, value) VALUES ('compression', ?)", (compression,))
+    conn.commit()
+    conn.close()
+    print(f"Recorded tile compression: {compression}")
 
 def main():
     # 1. Download raw OSM data (XML) from Overpass API
@@ -55,6 +116,8 @@ def main():
 
     try:
         subprocess.run(cmd, check=True)
+        compress_tiles(MBTILES_FILE)
+        record_compression(MBTILES_FILE)
         print(f"\nSUCCESS! {MBTILES_FILE} generated.")
         print("You can now restart the backend to see the map.")
     except subprocess.CalledProcessError as e:
@@ -1,14 +1,35 @@
 import sqlite3
 import math
-import json
-from fastapi import FastAPI, HTTPException, Response
+import asyncio
+import queue
+import struct
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import List, Tuple
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+import orjson
 import uvicorn
 import os
+import threading
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Loads per-run state once before serving, in dependency order:
+    tile encoding, then the map version, then the style (whose tile URL embeds the version).
+    """
+    app.state.tile_encoding = await asyncio.to_thread(read_tile_encoding)
+    # Added to the tile URL in style.json and to every ETag, so a regenerated map
+    # (picked up on restart) is fetched under new URLs instead of served from browser cache
+    app.state.tile_version = int(os.path.getmtime(MBTILES_PATH)) if os.path.exists(MBTILES_PATH) else 0
+    app.state.style_bytes = load_style(app.state.tile_version)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS for development flexibility
 app.add_middleware(
@@ -20,59 +41,290 @@ app.add_middleware(
 
 # --- Configuration ---
 MBTILES_PATH = "osm.mbtiles"
+# Number of SQLite connections shared by the tile-reading threads (per worker process);
+# threads beyond this wait for a free handle
+DB_POOL_SIZE = 4
+# SQLite page cache for the whole pool, split across connections. Kept small: hot
+# blobs already live in the tile cache and the rest is read through mmap
+DB_CACHE_BYTES = 32 * 1024 * 1024
+# Upper bound on tiles per /tiles/batch request (keeps the SQL parameter count bounded)
+MAX_BATCH_TILES = 256
+# Deepest zoom accepted in tile requests (keeps x/y within SQLite's 64-bit integers)
+MAX_ZOOM = 30
+# Memory budget for the in-process tile cache
+TILE_CACHE_BYTES = 64 * 1024 * 1024
 
-# --- Data Models ---
-class Waypoint(BaseModel):
+# --- Mock Data State (For Simulation) ---
+@dataclass(slots=True)
+class RobotState:
+    id: str
     lat: float
     lon: float
+    heading: int
 
-# --- Mock Data State (For Simulation) ---
 # Center roughly around San Francisco as per instructions
-robot_state = {
-    "id": "rover-01",
-    "lat": 37.41451,
-    "lon": -122.42215,
-    "heading": 90
+app.state.robot = RobotState(id="rover-01", lat=37.41451, lon=-122.42215, heading=90)
+
+# Static mission area; built and serialized once at import instead of on every request
+MISSION_GEOJSON = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "properties": {"name": "Zone Alpha", "type": "search_area"},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[
+                    [-122.4230, 37.4150],
+                    [-122.4210, 37.4150],
+                    [-122.4210, 37.4135],
+                    [-122.4230, 37.4135],
+                    [-122.4230, 37.4150]
+                ]]
+            }
+        }
+    ]
 }
 
+MISSION_GEOJSON_BYTES = orjson.dumps(MISSION_GEOJSON)
+
 # --- Helper: Map Tile Logic ---
-def get_tile_data(z, x, y):
+TILE_QUERY = "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+
+# Connections are opened lazily and handed out from a queue, so tile reads
+# running in the threadpool each get their own handle instead of connecting per tile.
+_pool = queue.Queue()
+_pool_lock = threading.Lock()
+_pool_opened = 0
+
+def open_connection():
     """
-    Reads a tile from the SQLite MBTiles file.
-    Converts XYZ (Google/OSM) Y-coordinate to TMS (Tile Map Service) Y-coordinate.
+    Opens a read-only connection to the MBTiles file.
+    Returns None if the file does not exist yet.
     """
     if not os.path.exists(MBTILES_PATH):
         print(f"Error: {MBTILES_PATH} not found.")
         return None
+    conn = sqlite3.connect(MBTILES_PATH, check_same_thread=False, isolation_level=None)
+    # Read-only tile service: map the file into memory; the page cache stays small (see DB_CACHE_BYTES)
+    conn.execute("PRAGMA query_only=1")
+    conn.execute("PRAGMA mmap_size=1073741824")
+    # Negative cache_size is in KiB
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_BYTES // DB_POOL_SIZE // 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def _acquire_connection():
+    global _pool_opened
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+    with _pool_lock:
+        if _pool_opened < DB_POOL_SIZE:
+            conn = open_connection()
+            if conn is not None:
+                _pool_opened += 1
+            return conn
+    # Pool is fully open and every handle is busy: wait for one to come back
+    return _pool.get()
+
+@contextmanager
+def tile_connection():
+    """Borrows a connection from the pool (None if the MBTiles file is missing)."""
+    conn = _acquire_connection()
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            _pool.put(conn)
+
+class TileCache:
+    """
+    Thread-safe LRU cache of raw tile blobs keyed on (z, x, y), bounded by total bytes.
+    Only found tiles are cached, so a map created after startup is served once it exists.
+    Replacing an existing map needs a server restart: pooled connections keep reading the
+    old file, and the tile version in style.json is fixed at startup.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile_data = self._tiles.get(key)
+            if tile_data is not None:
+                self._tiles.move_to_end(key)
+            return tile_data
+
+    def put(self, key, tile_data):
+        if len(tile_data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._tiles[key] = tile_data
+            self.size += len(tile_data)
+            while self.size > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.size -= len(evicted)
+
+tile_cache = TileCache(TILE_CACHE_BYTES)
+
+def is_valid_tile(z, x, y):
+    """True if z/x/y address a tile that can exist (bounded zoom, x and y inside the grid)."""
+    return 0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+def get_tile_data(z, x, y):
+    """
+    Reads a tile from the SQLite MBTiles file.
+    Converts XYZ (Google/OSM) Y-coordinate to TMS (Tile Map Service) Y-coordinate.
+    Blocking: call it from a worker thread, not from the event loop.
+    """
+    tile_data = tile_cache.get((z, x, y))
+    if tile_data is not None:
+        return tile_data
 
     # XYZ -> TMS conversion
     tms_y = (1 << z) - 1 - y
-    
-    conn = sqlite3.connect(MBTILES_PATH)
-    cursor = conn.cursor()
-    
-    # Query following the standard MBTiles schema
-    cursor.execute(
-        "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", 
-        (z, x, tms_y)
-    )
-    result = cursor.fetchone()
-    conn.close()
-    
+
+    with tile_connection() as conn:
+        if conn is None:
+            return None
+        # Query following the standard MBTiles schema
+        result = conn.execute(TILE_QUERY, (z, x, tms_y)).fetchone()
+
+    if not result:
+        return None
+    tile_data = result[0]
+    tile_cache.put((z, x, y), tile_data)
+    return tile_data
+
+def get_tiles_batch(coords):
+    """
+    Reads many tiles with one query per zoom level.
+    Takes XYZ (z, x, y) triples and returns (z, x, y, tile_data) for the tiles that exist.
+    Blocking: call it from a worker thread, not from the event loop.
+    """
+    found = []
+    # Serve cached tiles directly; group the rest by zoom so each level is a
+    # single indexed lookup over (column, row) pairs
+    by_zoom = {}
+    for z, x, y in coords:
+        tile_data = tile_cache.get((z, x, y))
+        if tile_data is not None:
+            found.append((z, x, y, tile_data))
+        else:
+            by_zoom.setdefault(z, []).append((x, (1 << z) - 1 - y))
+
+    if not by_zoom:
+        return found
+
+    with tile_connection() as conn:
+        if conn is None:
+            return found
+        for z, cols_rows in by_zoom.items():
+            values = ",".join(["(?,?)"] * len(cols_rows))
+            params = []
+            for col_row in cols_rows:
+                params.extend(col_row)
+            params.append(z)
+            # Join (rather than a row-value IN) so every pair is a full-index lookup
+            rows = conn.execute(
+                f"WITH wanted(col, row) AS (VALUES {values}) "
+                "SELECT tile_column, tile_row, tile_data FROM wanted CROSS JOIN tiles "
+                "ON zoom_level=? AND tile_column=wanted.col AND tile_row=wanted.row",
+                params
+            )
+            for x, tms_y, tile_data in rows:
+                y = (1 << z) - 1 - tms_y
+                tile_cache.put((z, x, y), tile_data)
+                found.append((z, x, y, tile_data))
+
+    return found
+
+def read_tile_encoding():
+    """
+    Returns the tile compression recorded in the MBTiles metadata ('gzip', 'none'),
+    or None if it is not recorded or the file does not exist yet.
+    """
+    try:
+        with tile_connection() as conn:
+            if conn is None:
+                return None
+            result = conn.execute("SELECT value FROM metadata WHERE name='compression'").fetchone()
+    except sqlite3.DatabaseError as e:
+        # Not a (complete) MBTiles file: don't block startup, tiles fall back to per-tile detection
+        print(f"Warning: could not read {MBTILES_PATH} metadata: {e}")
+        return None
+
     return result[0] if result else None
 
+def load_style(tile_version):
+    """
+    Parses the map style, injecting the host URL and the map version, and returns it
+    serialized (every request returns the same bytes). Returns None if style.json is missing.
+    """
+    try:
+        with open("static/style.json", "rb") as f:
+            style = orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+    # Ensure the tile source points to this server
+    # Note: In a real deploy, swap localhost for the actual IP or hostname
+    style["sources"]["openmaptiles"]["tiles"] = [
+        f"http://localhost:8000/tiles/{{z}}/{{x}}/{{y}}.pbf?v={tile_version:x}"
+    ]
+    return orjson.dumps(style)
+
+def orjson_response(content):
+    """
+    Serializes content with orjson (several times faster than the stdlib encoder)
+    into a plain JSON Response, without FastAPI's deprecated ORJSONResponse.
+    """
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
 # --- API Endpoints ---
+# Tile URLs carry the map version (see lifespan), so a given URL's content never
+# changes and browsers may keep it for a day without revalidating
+TILE_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+async def tile_server(request: Request):
+    """
+    Serves vector tiles from local SQLite database, handling Gzip compression.
+    Registered as a plain Starlette route: the path convertors already parse
+    z/x/y as ints, so FastAPI's parameter validation is skipped on this hot path.
+    Responses are cacheable and carry an ETag; a matching If-None-Match gets a 304.
+    """
+    params = request.path_params
+    z, x, y = params["z"], params["x"], params["y"]
+    # Reject out-of-range coordinates before they reach the cache, 1 << z or SQLite
+    if not is_valid_tile(z, x, y):
+        return Response(status_code=404)
 
-@app.get("/tiles/{z}/{x}/{y}.pbf")
-async def tile_server(z: int, x: int, y: int):
-    """Serves vector tiles from local SQLite database, handling Gzip compression"""
-    tile_data = get_tile_data(z, x, y)
+    etag = f'W/"{app.state.tile_version:x}-{z}-{x}-{y}"'
+    headers = {"Cache-Control": TILE_CACHE_CONTROL, "ETag": etag}
+
+    # The browser already has this tile: answer without touching the cache or SQLite
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    # Hot tiles are answered from memory without a thread hop
+    tile_data = tile_cache.get((z, x, y))
+    if tile_data is None:
+        tile_data = await asyncio.to_thread(get_tile_data, z, x, y)
     
     if tile_data:
-        headers = {}
-        # Check for GZIP magic bytes (0x1f 0x8b)
-        # If the tile starts with these bytes, it is compressed.
-        if tile_data[:2] == b'\x1f\x8b':
+        encoding = app.state.tile_encoding
+        if encoding is None:
+            # Compression not recorded in metadata: check for GZIP magic bytes (0x1f 0x8b)
+            # If the tile starts with these bytes, it is compressed.
+            encoding = "gzip" if tile_data[:2] == b'\x1f\x8b' else "none"
+        if encoding == "gzip":
             headers["Content-Encoding"] = "gzip"
 
         return Response(
@@ -83,82 +335,106 @@ async def tile_server(z: int, x: int, y: int):
     else:
         return Response(status_code=204)
 
+app.add_route("/tiles/{z:int}/{x:int}/{y:int}.pbf", tile_server, methods=["GET"], include_in_schema=False)
+
+@app.post("/tiles/batch")
+async def tile_batch(coords: List[Tuple[int, int, int]]):
+    """
+    Serves many vector tiles in one response.
+    Body is a JSON list of [z, x, y]. The response is a sequence of records, each a
+    little-endian uint32 header (z, x, y, length) followed by the raw tile bytes.
+    Missing tiles are omitted; tiles keep their stored compression, which is sent in
+    the X-Tile-Encoding header: 'gzip', 'none', or 'mixed' if the file doesn't record
+    it and tiles differ (clients then check each tile for the gzip magic bytes).
+    """
+    if len(coords) > MAX_BATCH_TILES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_TILES} tiles per batch")
+    if not all(is_valid_tile(z, x, y) for z, x, y in coords):
+        raise HTTPException(
+            status_code=422,
+            detail=f"Tile coordinates must satisfy 0 <= z <= {MAX_ZOOM} and 0 <= x, y < 2**z"
+        )
+
+    tiles = await asyncio.to_thread(get_tiles_batch, coords)
+
+    encoding = app.state.tile_encoding
+    if encoding is None:
+        # Compression not recorded in metadata: derive it from the tiles being sent
+        encodings = {"gzip" if tile_data[:2] == b'\x1f\x8b' else "none" for _, _, _, tile_data in tiles}
+        encoding = "mixed" if len(encodings) > 1 else encodings.pop() if encodings else "none"
+
+    def records():
+        for z, x, y, tile_data in tiles:
+            yield struct.pack("<IIII", z, x, y, len(tile_data))
+            yield tile_data
+
+    return StreamingResponse(
+        records(),
+        media_type="application/octet-stream",
+        headers={"X-Tile-Encoding": encoding}
+    )
+
 @app.get("/style.json")
 async def get_style():
-    """Returns the map style, dynamically injecting the host URL"""
-    try:
-        with open("static/style.json", "r") as f:
-            style = json.load(f)
-            # Ensure the tile source points to this server
-            # Note: In a real deploy, swap localhost for the actual IP or hostname
-            style["sources"]["openmaptiles"]["tiles"] = [
-                "http://localhost:8000/tiles/{z}/{x}/{y}.pbf"
-            ]
-            return style
-    except FileNotFoundError:
+    """Returns the map style parsed at startup"""
+    if app.state.style_bytes is None:
         raise HTTPException(status_code=404, detail="style.json not found")
+    return Response(content=app.state.style_bytes, media_type="application/json")
 
 @app.get("/api/mission")
 async def get_mission():
     """Returns a static GeoJSON Polygon representing the mission area"""
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "properties": {"name": "Zone Alpha", "type": "search_area"},
-                "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [[
-                        [-122.4230, 37.4150],
-                        [-122.4210, 37.4150],
-                        [-122.4210, 37.4135],
-                        [-122.4230, 37.4135],
-                        [-122.4230, 37.4150]
-                    ]]
-                }
-            }
-        ]
-    }
+    return Response(content=MISSION_GEOJSON_BYTES, media_type="application/json")
 
 @app.get("/api/robot")
 async def get_robot():
     """Returns robot position. Simulates slight movement for testing."""
-    global robot_state
-    
+    robot = app.state.robot
+
     # Simulate movement (wobble)
-    robot_state["lon"] += 0.00001
-    if robot_state["lon"] > -122.420: 
-        robot_state["lon"] = -122.42215 # Reset if it goes too far
-        
-    return {
+    # No await between read and write, so the update can't interleave with another request
+    robot.lon += 0.00001
+    if robot.lon > -122.420:
+        robot.lon = -122.42215 # Reset if it goes too far
+
+    return orjson_response({
         "type": "FeatureCollection",
         "features": [
             {
                 "type": "Feature",
                 "properties": {
-                    "id": robot_state["id"], 
-                    "heading": robot_state["heading"],
+                    "id": robot.id,
+                    "heading": robot.heading,
                     "status": "ARMED"
                 },
                 "geometry": {
                     "type": "Point",
-                    "coordinates": [robot_state["lon"], robot_state["lat"]]
+                    "coordinates": [robot.lon, robot.lat]
                 }
             }
         ]
-    }
+    })
 
 @app.post("/api/waypoint")
-async def post_waypoint(wp: Waypoint):
-    """Receives a waypoint from the UI"""
+async def post_waypoint(request: Request):
+    """Receives a waypoint from the UI. The body is decoded directly with orjson."""
+    try:
+        data = orjson.loads(await request.body())
+        wp = {"lat": float(data["lat"]), "lon": float(data["lon"])}
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=422, detail="Expected a JSON object with numeric lat and lon")
+
     print(f"--- COMMAND RECEIVED ---")
-    print(f"Target: Lat {wp.lat}, Lon {wp.lon}")
+    print(f"Target: Lat {wp['lat']}, Lon {wp['lon']}")
     print(f"Action: Forwarding to MAVLink handler (Stub)")
-    return {"status": "accepted", "target": wp}
+    return orjson_response({"status": "accepted", "target": wp})
 
 # Mount static files (Frontend) - Must be last to avoid overriding API routes
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # "auto" picks uvloop + httptools when installed (uvicorn[standard]) and falls back otherwise.
+    # Single worker by default: each worker has its own connection pool, tile cache and
+    # simulated robot, so with GCS_WORKERS > 1 the robot position differs between polls.
+    workers = int(os.environ.get("GCS_WORKERS", 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="auto", http="auto", workers=workers)